@@ -1,19 +1,49 @@
 import boto3
 import os
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 
 bucket_name = "s3-bucket-bedrock-project-malli"  # <-- your bucket
 prefix = "documents/"  # folder inside S3 where files will go
 
-s3 = boto3.client("s3")
+max_workers = 16  # files uploaded in parallel
+part_concurrency = 4  # parts uploaded in parallel for each large file
+
+# one client shared by all upload threads (boto3 clients are thread-safe); pool sized for every in-flight part
+s3 = boto3.client("s3", config=Config(
+    max_pool_connections=max_workers * part_concurrency,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    tcp_keepalive=True,
+))
+
+# files above 8 MB are split into 8 MB parts that upload concurrently
+transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=part_concurrency,
+    use_threads=True,
+)
 
 local_folder = os.path.join("spec-sheets")
 
-for filename in os.listdir(local_folder):
-    if filename.endswith(".pdf") or filename.endswith(".txt"):
-        local_path = os.path.join(local_folder, filename)
-        s3_key = f"{prefix}{filename}"
 
-        print(f"Uploading {filename} to {s3_key}...")
-        s3.upload_file(local_path, bucket_name, s3_key)
+def upload(filename):
+    local_path = os.path.join(local_folder, filename)
+    s3_key = f"{prefix}{filename}"
+
+    print(f"Uploading {filename} to {s3_key}...")
+    s3.upload_file(local_path, bucket_name, s3_key, Config=transfer_config)
+
+
+upload_suffixes = (".pdf", ".txt")
+
+# scandir reuses the directory entry's type info, so subfolders are skipped without an extra stat per file
+with os.scandir(local_folder) as entries:
+    files = [entry.name for entry in entries if entry.is_file() and entry.name.endswith(upload_suffixes)]
+
+with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    # list() drains the iterator so any upload error is raised here
+    list(executor.map(upload, files))
 
 print("Upload completed successfully.")